@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+
+"""bench_parallel
+
+Usage:
+  bench_parallel [--pages=<pages>] [--maxjobs=<jobs>]
+
+Times [Illustration] conversion and .il/.ca parsing of a generated source
+for 1..maxjobs processes, and checks every result is identical to the
+single process run.
+
+Options:
+  --pages=<pages>   Number of scan pages in generated source [default: 40000]
+  --maxjobs=<jobs>  Largest number of processes to time [default: 0]
+  -h, --help        Show help.
+"""
+
+from docopt import docopt
+from PIL import Image
+import logging
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import ppimg
+
+
+def buildProject( path, pages ):
+	# Source with an illustration on every 7th page, two on every 14th,
+	# and an image file for some of them
+	os.mkdir(os.path.join(path, "images"))
+	lines = []
+	for p in range(1, pages+1):
+		pg = "{:05d}".format(p)
+		lines.append("-----File: {}.png---\\Proofer\\".format(pg))
+		lines += ["Line {} of page text with [brackets].".format(i) for i in range(1 + p % 9)]
+		if p % 7 == 0:
+			lines += ["[Illustration: Caption for page {}]".format(p), ""]
+		if p % 14 == 0:
+			lines += ["[Illustration: Second plate", "caption on [two] lines]", ""]
+		if p % 70 == 0:
+			Image.new("1", (100 + p % 500, 50)).save(os.path.join(path, "images", "i_{}.png".format(pg)))
+	return lines
+
+
+def timeRun( inBuf, project ):
+	start = time.perf_counter()
+	outBuf = ppimg.processIllustrations(inBuf, project)
+	illustrations = ppimg.parseIllustrationBlocks(outBuf, project)
+	return time.perf_counter() - start, outBuf, illustrations
+
+
+def main():
+	args = docopt(__doc__)
+	pages = int(args['--pages'])
+	maxJobs = int(args['--maxjobs']) or os.cpu_count()
+
+	logging.basicConfig(level=logging.CRITICAL)
+
+	with tempfile.TemporaryDirectory(prefix="ppimgbench") as path:
+		inBuf = buildProject(path, pages)
+		print("{} pages, {} lines, {} cpus".format(pages, len(inBuf), os.cpu_count()))
+
+		baseTime, baseOut, baseIl = timeRun(inBuf, ppimg.Project(path, jobs=1))
+		print("jobs=1  {:7.2f}s  speedup 1.00".format(baseTime))
+
+		for jobs in range(2, maxJobs+1):
+			elapsed, outBuf, illustrations = timeRun(inBuf, ppimg.Project(path, jobs=jobs))
+			if "\n".join(outBuf) != "\n".join(baseOut) or illustrations != baseIl:
+				sys.exit("jobs={} output differs from jobs=1".format(jobs))
+			print("jobs={:<2} {:7.2f}s  speedup {:.2f}".format(jobs, elapsed, baseTime / elapsed))
+
+
+if __name__ == "__main__":
+	main()
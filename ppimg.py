@@ -3,7 +3,9 @@
 """ppimg
 
 Usage:
-  ppimg [options] <infile> [<outfile>]
+  ppimg [options] [--optimize] [--trim] <infile> [<outfile>]
+  ppimg [options] [--trim] --optimize
+  ppimg [options] --trim
   ppimg --gettargetwidth=<image>
   ppimg -h | --help
   ppimg ---version
@@ -17,12 +19,17 @@ Examples:
 
 Options:
   -b, --boilerplate     Generate HTML boilerplate code from .il/.ca markup.
+  --native              Render boilerplate with the built-in renderer instead of ppgen (experimental)
   -c, --check           Check for issues with .il markup
   --calcimagewidths     Calculate and set w= parameter to px based on % from w= or ew=
   --maxwidth=<maxwidth> Maximum width of images, used as scale reference during calcimagewidths
   -d, --dryrun          Run through conversions but do not write out result
   -i, --illustrations   Convert raw [Illustration] tags into ppgen .il/.ca markup.
+  -o, --optimize        Losslessly reduce file size of PNG images in images/
+  -j, --jobs=<jobs>     Number of processes used on large sources [default: 1]
   -q, --quiet           Print less text.
+  -t, --trim            Crop plain borders from PNG images in images/, then update .il widths
+  --trimtolerance=<t>   Difference from border color counted as content [default: 16]
   -v, --verbose         Print more text.
   -w, --updatewidths    Update .il width parameters to files pixel dimensions.
   -h, --help            Show help.
@@ -31,6 +38,7 @@ Options:
 
 from docopt import docopt
 from PIL import Image
+from PIL import PngImagePlugin
 from bs4 import BeautifulSoup
 import glob
 import re
@@ -40,9 +48,61 @@ import logging
 import subprocess
 import json
 import shlex
+import collections
+import tempfile
+import concurrent.futures
+import multiprocessing
+import io
+
+try:
+	import numpy
+except ImportError:
+	numpy = None
 
 VERSION="0.1.0" # MAJOR.MINOR.PATCH | http://semver.org
 
+# Sources shorter than this are processed in a single chunk, starting a
+# process pool costs more than it saves
+PARALLEL_MIN_LINES = 50000
+
+
+class PPImgError(Exception):
+	pass
+
+
+class Project:
+	# Locations of the files belonging to one book project. Every function
+	# that touches the filesystem takes a Project so that several projects can
+	# be processed in the same process without depending on the working
+	# directory.
+	def __init__( self, path=".", imageDir="images", jsonFile="images.json", originalsDir=os.path.join("originals","illustrations"), log=None, jobs=1 ):
+		self.path = os.path.abspath(path)
+		self.imageDirName = imageDir
+		self.imageDir = os.path.join(self.path, imageDir)
+		self.jsonFile = os.path.join(self.path, jsonFile)
+		self.originalsDir = os.path.join(self.path, originalsDir)
+		self.log = log if log else logging.getLogger("ppimg")
+		self.jobs = jobs # processes used to convert/parse large sources
+
+	def imagePath( self, fn ):
+		return os.path.join(self.imageDir, fn)
+
+	def jsonKey( self, fn ):
+		# images.json is keyed by path relative to the project, "images/i_001.jpg"
+		return "{}/{}".format(self.imageDirName, fn)
+
+	def executor( self ):
+		# Process pool for parallel work. Workers are never forked from this
+		# process, which may be running other threads (forking those can
+		# deadlock on locks held at the time, logging for example).
+		if "forkserver" in multiprocessing.get_all_start_methods():
+			context = multiprocessing.get_context("forkserver")
+		else:
+			context = multiprocessing.get_context("spawn")
+
+		return concurrent.futures.ProcessPoolExecutor(max_workers=self.jobs, mp_context=context)
+
+
 def isLineBlank( line ):
 	return re.match(r"^\s*$", line)
 
@@ -62,6 +122,26 @@ def idFromPageNumber( pn ):
 	return id
 
 
+def pageNumberFromID( id ):
+	# Inverse of idFromPageNumber, also strips the suffix used when several
+	# images share a scan page (i_001a -> 001)
+	m = re.match(r"i_(\w+?)[a-z]?$", id)
+	if m:
+		return m.group(1)
+
+	return None
+
+
+def scanPageKey( pn ):
+	# Normalize a scan page number for lookups, so that 12, "12" and "012"
+	# all refer to the same page
+	pn = str(pn)
+	if pn.isdigit():
+		pn = str(int(pn))
+
+	return pn
+
+
 def parseScanPage( line ):
 	scanPageNum = None
 
@@ -96,9 +176,15 @@ def findNextNonEmptyLine( buf, startLine ):
 	return lineNum
 
 def fatal( errorMsg ):
-	logging.critical(errorMsg)
-	exit(1)
-	return
+	raise PPImgError(errorMsg)
+
+
+def parseInt( value, option, minimum=0 ):
+	# Validate integer command line value
+	if not re.match(r"^\d+$", str(value)) or int(value) < minimum:
+		fatal("{} must be a whole number >= {}, got '{}'".format(option,minimum,value))
+
+	return int(value)
 
 # For a given ppgen command, parse all arguments in the form
 # 	arg="val"
@@ -129,18 +215,19 @@ def getFileSizeInKb( fn ):
 
 	return sizeInKb
 
-def checkForIssues( inBuf ):
+def checkForIssues( inBuf, project=None ):
+	project = project if project else Project()
 
-	images = buildImageDictionary()
-	illustrations = parseIllustrationBlocks(inBuf)
+	images = buildImageDictionary(project)
+	illustrations = parseIllustrationBlocks(inBuf, project)
 
-	logging.info("--- Checking for issues")
+	project.log.info("--- Checking for issues")
 
 	for k, i in sorted(images.items()):
 		# Unused images
 #		if not k in illustrations and i['fileName'] != "cover.jpg":
 		if not k in illustrations:
-			logging.error("Unused image {}".format(i['fileName']))
+			project.log.error("Unused image {}".format(i['fileName']))
 
 		#	Image Display Dimensions: General Guidelines
 		#		Thumbnail: under 40 KB, 300 - 400 pixels in width or height (whichever is larger)
@@ -151,152 +238,353 @@ def checkForIssues( inBuf ):
 		MAX_SIZE=100
 		w = i['dimensions'][0]
 		h = i['dimensions'][1]
-		size = int(getFileSizeInKb(os.path.join("images", i['fileName'])))
+		size = int(getFileSizeInKb(project.imagePath(i['fileName'])))
 		if w > MAX_W:
-			logging.warning("{} width {}px > {}px".format(i['fileName'],w,MAX_W))
+			project.log.warning("{} width {}px > {}px".format(i['fileName'],w,MAX_W))
 		if h > MAX_H:
-			logging.warning("{} height {}px > {}px".format(i['fileName'],h,MAX_H))
+			project.log.warning("{} height {}px > {}px".format(i['fileName'],h,MAX_H))
 		if size > MAX_SIZE:
-			logging.warning("{} size {}KB > {}KB".format(i['fileName'],size,MAX_SIZE))
+			project.log.warning("{} size {}KB > {}KB".format(i['fileName'],size,MAX_SIZE))
 
 
 	for k, i in sorted(illustrations.items()):
 
 		# Missing images
 		if not k in images:
-			logging.error("Missing image {}".format(i['ilParams']['fn']))
+			project.log.error("Missing image {}".format(i['ilParams']['fn']))
 
 		# w= parameter specified in px does not match actual width
 		if not '%' in i['ilParams']['w']:
 			w = int(re.sub("[^0-9]","",i['ilParams']['w']))
 			if k in images and w != images[k]['dimensions'][0]:
-				logging.error("w parameter ({}px) does not match actual image width ({}px)\nLine {}: {}".format(w,images[k]['dimensions'][0],i['startLine'],i['ilStatement']))
+				project.log.error("w parameter ({}px) does not match actual image width ({}px)\nLine {}: {}".format(w,images[k]['dimensions'][0],i['startLine'],i['ilStatement']))
 
 	return
 
 
 
-def buildImageDictionary():
+def buildImageDictionary( project=None ):
+	project = project if project else Project()
+
 	# Build dictionary of image files in images/ directory
-	files = sorted(glob.glob("images/*"))
+	files = sorted(glob.glob(os.path.join(project.imageDir, "*")))
+
+	# Optional per image settings, entries in the form
+	#	"images/plate3.jpg": { "id": "i_012a", "scanPage": "012" }
+	jsonData = {}
+	if os.path.isfile(project.jsonFile):
+		jsonData = loadJSON(project.jsonFile, project)
 
-	logging.info("--- Taking inventory of /image folder")
+	project.log.info("--- Taking inventory of /image folder")
 	images = {}
 	for f in files:
 		try:
-			img = Image.open(f)
-			img.load()
+			with Image.open(f) as img:
+				img.load()
 		except IOError:
-			logging.warning("Error loading '{}' ... skipping".format(f))
+			project.log.warning("Error loading '{}' ... skipping".format(f))
 		except:
 			raise
 		else:
 			fn = os.path.basename(f)
-			anchorID = idFromFilename(fn)
-			logging.debug("Found image id={} fn='{}' size={}".format(anchorID,fn,img.size))
-			scanPageNum = re.sub("[^0-9]","",fn)
+			settings = jsonData.get(project.jsonKey(fn), {})
+			anchorID = settings.get('id', idFromFilename(fn))
+			project.log.debug("Found image id={} fn='{}' size={}".format(anchorID,fn,img.size))
+			scanPageNum = settings.get('scanPage', pageNumberFromID(anchorID))
 			key = idFromFilename(fn)
 			images[key] = ({'anchorID':anchorID, 'fileName':fn, 'scanPageNum':scanPageNum, 'dimensions':img.size, 'caption':"", 'usageCount':0 })
 
-			if not re.match(r"i_\d{3,4}[a-z]?\.", fn) and fn != "cover.jpg":
-				logging.warning("File '{}' does not match expected naming convention (i_001, i_001a)".format(fn))
+			if not 'id' in settings and not re.match(r"i_\d{3,4}[a-z]?\.", fn) and fn != "cover.jpg":
+				project.log.warning("File '{}' does not match expected naming convention (i_001, i_001a)".format(fn))
 
 #	print(images)
-	logging.info("----- Found {} images".format(len(images)))
+	project.log.info("----- Found {} images".format(len(images)))
 
 	return images;
 
 
-def parseIllustrationBlocks( inBuf ):
-	outBuf = []
+def buildImageIndex( images ):
+	# Build queue of unused images for each scan page, ordered so that images
+	# sharing a page are assigned in name order (i_001, i_001a, i_001b, ...)
+	index = {}
+	for k, i in sorted(images.items(), key=lambda item: item[1]['anchorID']):
+		if i['scanPageNum'] != None and str(i['scanPageNum']) != "":
+			index.setdefault(scanPageKey(i['scanPageNum']), collections.deque()).append(k)
+
+	return index
+
+
+def splitAtScanPages( inBuf, chunkCount ):
+	# Split source into about chunkCount pieces for parallel processing. Every
+	# piece except the first starts with a -----File: line, so the scan page
+	# is known at the start of each piece. Returns a list of (offset, lines).
+	chunkSize = max(1, len(inBuf) // max(1, chunkCount))
+
+	starts = [0]
+	for lineNum, line in enumerate(inBuf):
+		if lineNum - starts[-1] >= chunkSize and line.startswith("-----File:") and parseScanPage(line):
+			starts.append(lineNum)
+
+	ends = starts[1:] + [len(inBuf)]
+	return [(start, inBuf[start:end]) for start, end in zip(starts, ends)]
+
+
+def splitForJobs( inBuf, project ):
+	if project.jobs > 1 and len(inBuf) >= PARALLEL_MIN_LINES:
+		return splitAtScanPages(inBuf, project.jobs * 4)
+
+	return [(0, inBuf)]
+
+
+def mapChunks( function, chunks, project ):
+	# Call function(lines, isLast) for each chunk, in a process pool when
+	# more than one job is requested. Results are returned in source order.
+	isLast = [n == len(chunks)-1 for n in range(len(chunks))]
+	lines = [chunk for offset, chunk in chunks]
+
+	if project.jobs > 1 and len(chunks) > 1:
+		with project.executor() as executor:
+			return list(executor.map(function, lines, isLast))
+
+	return list(map(function, lines, isLast))
+
+
+def parseIllustrationChunk( inBuf, isLast=True ):
+	# Parse .il/.ca statements in inBuf, returns a list of entries in source
+	# order with line numbers relative to inBuf. Returns None when a statement
+	# runs past the end of a chunk that is not the last one.
 	lineNum = 0
 	currentScanPage = 0;
-	illustrations = {};
+	entries = [];
 
-	logging.info("--- Parsing .il/.ca statements from input")
-	while lineNum < len(inBuf):
-		# Keep track of active scanpage, page numbers must be
-		pn = parseScanPage(inBuf[lineNum])
-		if pn:
-			currentScanPage = os.path.splitext(pn)[0]
-			logging.debug("--- Processing page {}".format(pn))
-
-		# Find next .il/.ca, discard all other lines
-		if re.match(r"^\.il ", inBuf[lineNum]):
-			logging.debug("Line {}: Found .il '{}'".format(lineNum,inBuf[lineNum]))
-			startLine = lineNum
-			inBlock = []
-			captionBlock = []
+	try:
+		while lineNum < len(inBuf):
+			# Keep track of active scanpage, page numbers must be
+			pn = parseScanPage(inBuf[lineNum])
+			if pn:
+				currentScanPage = os.path.splitext(pn)[0]
+
+			# Find next .il/.ca, discard all other lines
+			if re.match(r"^\.il ", inBuf[lineNum]):
+				startLine = lineNum
+				inBlock = []
+				captionBlock = []
+
+				ilStatement = inBuf[lineNum]
+				inBlock.append(inBuf[lineNum])
+				lineNum += 1
 
-			ilStatement = inBuf[lineNum]
-			inBlock.append(inBuf[lineNum])
-			lineNum += 1
+				ilParams = parseArgs(ilStatement)
 
-			ilParams = parseArgs(ilStatement)
-
-			# Is there a caption?
-			if re.match(r"^\.ca", inBuf[lineNum]):
-				# Is .ca single line style?
-				if re.match(r"^\.ca \S+", inBuf[lineNum]):
-					inBlock.append(inBuf[lineNum])
-					caption = re.sub("^\.ca ","", inBuf[lineNum]) # strip ".ca "
-					captionBlock.append(caption)
-					lineNum += 1
-				# Its a block
-				else:
-					# Copy caption block
-					inBlock.append(inBuf[lineNum])
-					while not re.match(r"^\.ca\-", inBuf[lineNum]):
+				# Is there a caption?
+				if re.match(r"^\.ca", inBuf[lineNum]):
+					# Is .ca single line style?
+					if re.match(r"^\.ca \S+", inBuf[lineNum]):
+						inBlock.append(inBuf[lineNum])
+						caption = re.sub("^\.ca ","", inBuf[lineNum]) # strip ".ca "
+						captionBlock.append(caption)
 						lineNum += 1
+					# Its a block
+					else:
+						# Copy caption block
 						inBlock.append(inBuf[lineNum])
-						captionBlock.append(inBuf[lineNum])
+						while not re.match(r"^\.ca\-", inBuf[lineNum]):
+							lineNum += 1
+							inBlock.append(inBuf[lineNum])
+							captionBlock.append(inBuf[lineNum])
 
-				endLine = lineNum + 1
+					endLine = lineNum + 1
 
+				else:
+					endLine = lineNum
+
+				entries.append({'ilStatement':ilStatement, 'captionBlock':captionBlock, 'ilBlock':inBlock, 'HTML':"", 'startLine':startLine, 'endLine':endLine, 'ilParams':ilParams, 'scanPageNum':currentScanPage })
 			else:
-				endLine = lineNum
+				# Ignore lines that aren't .il/.ca
+				lineNum += 1
+	except IndexError:
+		if isLast:
+			raise
+		return None
+
+	return entries
+
+
+def parseIllustrationBlocks( inBuf, project=None ):
+	project = project if project else Project()
+	illustrations = {};
+
+	project.log.info("--- Parsing .il/.ca statements from input")
+	chunks = splitForJobs(inBuf, project)
+	results = mapChunks(parseIllustrationChunk, chunks, project)
+	if None in results:
+		project.log.debug("--- .il/.ca statement spans a chunk boundary, parsing sequentially")
+		chunks = [(0, inBuf)]
+		results = [parseIllustrationChunk(inBuf)]
+
+	for (offset, chunk), entries in zip(chunks, results):
+		for il in entries:
+			il['startLine'] += offset
+			il['endLine'] += offset
+			project.log.debug("Line {}: ScanPage {}: Found .il '{}'".format(il['startLine'],il['scanPageNum'],il['ilStatement']))
 
 			# Add entry in dictionary
-			key = idFromFilename(ilParams['fn'])
-			illustrations[key] = ({'ilStatement':ilStatement, 'captionBlock':captionBlock, 'ilBlock':inBlock, 'HTML':"", 'startLine':startLine, 'endLine':endLine, 'ilParams':ilParams, 'scanPageNum':currentScanPage })
-		else:
-			# Ignore lines that aren't .il/.ca
-			lineNum += 1
+			key = idFromFilename(il['ilParams']['fn'])
+			illustrations[key] = il
 
-	logging.info("----- Found {} .il statements".format(len(illustrations)))
+	project.log.info("----- Found {} .il statements".format(len(illustrations)))
 
 	return illustrations
 
 
-def buildBoilerplateDictionary( inBuf ):
-	outBuf = []
-	lineNum = 0
-
-	boilerplate = {};
-	illustrations = parseIllustrationBlocks(inBuf)
+# CSS ppgen emits for each illustration alignment
+FIGURE_CSS = {
+	'c': [".figcenter { clear:both; max-width:100%; margin:2em auto; text-align:center; }",
+	      "div.figcenter p { text-align:center; text-indent:0; }",
+	      ".figcenter img { max-width:100%; height:auto; }"],
+	'l': [".figleft { clear:left; float:left; max-width:100%; margin:0.5em 1em 1em 0; text-align:left; }",
+	      "div.figleft p { text-align:center; text-indent:0; }",
+	      ".figleft img { max-width:100%; height:auto; }"],
+	'r': [".figright { clear:right; float:right; max-width:100%; margin:0.5em 0 1em 1em; text-align:right; }",
+	      "div.figright p { text-align:center; text-indent:0; }",
+	      ".figright img { max-width:100%; height:auto; }"],
+}
+FIGURE_CLASS = { 'c':"figcenter", 'l':"figleft", 'r':"figright" }
+
+
+def renderCaptionHTML( captionBlock ):
+	# Blank lines separate paragraphs, line breaks within a paragraph are kept
+	paragraphs = []
+	lines = []
+	for line in captionBlock:
+		if re.match(r"^\.ca\-", line):
+			continue
+		if isLineBlank(line):
+			if lines:
+				paragraphs.append(lines)
+			lines = []
+		else:
+			lines.append(re.sub(r"&(?!#?\w+;)", "&amp;", line.strip()))
+	if lines:
+		paragraphs.append(lines)
+
+	return ["<p>{}</p>".format("<br/>".join(lines)) for lines in paragraphs]
+
+
+def renderIllustrationHTML( il, number ):
+	# Produce the HTML and CSS ppgen generates for a single .il/.ca block.
+	# Returns None for markup the renderer does not handle, in which case ppgen
+	# should be used instead.
+	ilParams = il['ilParams']
+
+	if set(ilParams) - set(['id','fn','link','alt','w','ew','eh','align']):
+		return None
+	if not 'id' in ilParams:
+		return None # runPpgen only collects illustrations that have an id
+	for line in il['captionBlock']:
+		if re.search(r"<(?!/?[ib]>)", line):
+			return None
+
+	align = ilParams.get('align', 'c')[0].lower()
+	if not align in FIGURE_CLASS:
+		return None
+
+	# Screen width, and width as percentage of the screen for handheld devices
+	width = ilParams.get('w', "100%")
+	if 'ew' in ilParams:
+		epubWidth = ilParams['ew']
+	elif "%" in width:
+		epubWidth = width
+	else:
+		epubWidth = "100%"
+	if not re.match(r"^\d+(px|%)$", width) or not re.match(r"^\d+(\.\d+)?%$", epubWidth):
+		return None
+	epubWidth = float(epubWidth[:-1])
+	marginLeft = (100 - epubWidth) / 2 if align == 'c' else 0
+
+	css = []
+	css.append(".id{:03d} {{ width:{}; }}".format(number, width))
+	css.append("@media handheld {{ .id{:03d} {{ margin-left:{:g}%; width:{:g}%; }} }}".format(number, marginLeft, epubWidth))
+	css.append(".ig{:03d} {{ width:100%; }}".format(number))
+	css.append(".ic{:03d} {{ width:100%; }}".format(number))
+
+	html = []
+	html.append('<div class="{} id{:03d}" id="{}">'.format(FIGURE_CLASS[align], number, ilParams['id']))
+	img = '<img alt="{}" class="ig{:03d}" src="images/{}"/>'.format(ilParams.get('alt', "").replace('&',"&amp;").replace('"',"&quot;"), number, ilParams['fn'])
+	if 'link' in ilParams:
+		img = '<a href="images/{}">{}</a>'.format(ilParams['link'], img)
+	html.append(img)
+	caption = renderCaptionHTML(il['captionBlock'])
+	if caption:
+		html.append('<div class="ic{:03d}">'.format(number))
+		html.extend(caption)
+		html.append('</div>')
+	html.append('</div>')
+
+	return "\n".join(html), css
+
+
+def renderIllustrations( illustrations, project ):
+	# Native replacement for runPpgen, fills in HTML of each illustration and
+	# returns CSS lines, or None if any illustration needs ppgen
+	project.log.info("--- Rendering .il/.ca statements")
+	alignments = set()
+	illustrationCSS = []
+	rendered = {}
+
+	for number, (k, il) in enumerate(illustrations.items(), 1):
+		result = renderIllustrationHTML(il, number)
+		if result == None:
+			project.log.warning("Unable to render '{}' natively, using ppgen for all illustrations".format(il['ilStatement']))
+			return None
+
+		rendered[k], css = result
+		illustrationCSS.extend(css)
+
+		alignments.add(il['ilParams'].get('align', 'c')[0].lower())
+
+	for k, html in rendered.items():
+		illustrations[k]['HTML'] = html
+
+	# Figure rules come in a fixed order, independent of which alignment is used first
+	figureCSS = []
+	for align in ['c', 'l', 'r']:
+		if align in alignments:
+			figureCSS.extend(FIGURE_CSS[align])
+
+	return figureCSS + illustrationCSS
+
+
+def runPpgen( illustrations, project ):
+	# Run ppgen against the .il/.ca statements, fills in HTML of each
+	# illustration and returns CSS lines related to illustrations
+	with tempfile.TemporaryDirectory(prefix="ppimg") as tempDir:
+		project.log.info("--- Generating temporary ppgen source file containing parsed .il/.ca statements")
+		tempFileName = os.path.join(tempDir, "ppimgtempsrc")
+		with open(tempFileName,'w') as f:
+			for k, il in illustrations.items():
+				for line in il['ilBlock']:
+					f.write(line+'\n')
+				f.write('\n')
+
+		project.log.info("--- Running ppgen against temporary ppgen source file")
+		ppgenCommandLine=['ppgen','-i',tempFileName] # TODO: this wont work on windows?
+		try:
+			proc=subprocess.Popen(ppgenCommandLine, cwd=tempDir)
+		except OSError as e:
+			fatal("Unable to run ppgen: {}".format(e))
+		proc.wait()
+		if proc.returncode != 0:
+			fatal("Error occured during ppgen processing")
+
+		project.log.info("--- Parsing ppgen generated HTML")
+		# Open ppgen generated HTML and represent as an array of lines
+		infile = tempFileName + ".html"
+		inBuf = loadFile(infile)
+		with open(infile) as f:
+			soup = BeautifulSoup(f)
 
-	logging.info("--- Generating temporary ppgen source file containing parsed .il/.ca statements")
-	tempFileName = "ppimgtempsrc" # TODO: use tempfile functions instead? will clobber existing if named exists
-	f = open(tempFileName,'w')
-	for k, il in illustrations.items():
-		for line in il['ilBlock']:
-			f.write(line+'\n')
-		f.write('\n')
-	f.close()
-
-	logging.info("--- Running ppgen against temporary ppgen source file")
-	ppgenCommandLine=['ppgen','-i',tempFileName] # TODO: this wont work on windows?
-	proc=subprocess.Popen(ppgenCommandLine)
-	proc.wait()
-	if proc.returncode != 0:
-		fatal("Error occured during ppgen processing")
-
-	logging.info("--- Parsing ppgen generated HTML")
-	# Open ppgen generated HTML and represent as an array of lines
-	infile = tempFileName + ".html"
-	inBuf = loadFile(infile)
-
-	logging.info("----- Parsing CSS")
+	project.log.info("----- Parsing CSS")
 	cssLines = []
 
 	for line in inBuf:
@@ -309,25 +597,36 @@ def buildBoilerplateDictionary( inBuf ):
 			re.search(r"\.fig(left|right|center)", line) ):
 			line = re.sub("(\s{2,}|\t)","",line) # get rid of whitespace in front
 			cssLines.append(line)
-			logging.debug("Add css: "+line)
+			project.log.debug("Add css: "+line)
 
-	logging.info("----- Parsing HTML")
-	# Soupify HTML
-	soup = BeautifulSoup(open(infile))
+	project.log.info("----- Parsing HTML")
 	ilBlocks = soup.find_all('div',id=re.compile("$"))
 	for il in ilBlocks:
 		src = il.img['src']
 		key = idFromFilename(src)
 		illustrations[key]['HTML'] = str(il);
 
+	return cssLines
+
+
+def buildBoilerplateDictionary( inBuf, project=None, native=False ):
+	project = project if project else Project()
+
+	illustrations = parseIllustrationBlocks(inBuf, project)
+
+	cssLines = None
+	if native:
+		cssLines = renderIllustrations(illustrations, project)
+	if cssLines == None:
+		cssLines = runPpgen(illustrations, project)
+
 	return illustrations, cssLines
 
 
-def generateHTMLBoilerplate( inBuf ):
+def generateHTMLBoilerplate( inBuf, project=None, native=False ):
 #psuedocode:
-# create temporary ppgen source file that contains only .il/.ca lines
-# run ppgen on temporary source file
-# parse CSS (related to illustrations/captions) and illustration related HTML from output
+# render .il/.ca lines to HTML/CSS by running ppgen on a temporary source file
+# that contains only .il/.ca lines (or directly with the native renderer)
 # using parsed css, add .de statements to output
 # replace existing .il/.ca statements with
 #	 .if t
@@ -339,17 +638,18 @@ def generateHTMLBoilerplate( inBuf ):
 #    .li-
 #	 .if-
 
-	logging.info("-- Generating HTML Boilerplate")
+	project = project if project else Project()
+	project.log.info("-- Generating HTML Boilerplate")
 
-	boilerplate, cssLines = buildBoilerplateDictionary(inBuf)
+	boilerplate, cssLines = buildBoilerplateDictionary(inBuf, project, native)
 
-	logging.info("-- Adding boilerplate to original")
+	project.log.info("-- Adding boilerplate to original")
 	outBuf = []
-	logging.info("--- Adding CSS")
+	project.log.info("--- Adding CSS")
 	for line in cssLines:
 		outBuf.append(".de " + line)
 
-	logging.info("--- Adding HTML")
+	project.log.info("--- Adding HTML")
 	lineNum = 0
 	while lineNum < len(inBuf):
 		if re.match(r"^\.il ", inBuf[lineNum]):
@@ -359,7 +659,7 @@ def generateHTMLBoilerplate( inBuf ):
 
 			# Sanity check.. TODO: is it legal for multiple illustrations to share the same id?
 			if boilerplate[ilKey]['startLine'] != lineNum:
-				logging.warning("Illustration id='{}' found on unexpected line {}".format(ilKey,lineNum))
+				project.log.warning("Illustration id='{}' found on unexpected line {}".format(ilKey,lineNum))
 
 			# Replace .il/.ca block with HTML
 			outBuf.append(".if t")
@@ -382,26 +682,24 @@ def generateHTMLBoilerplate( inBuf ):
 	return outBuf
 
 
-def processIllustrations( inBuf ):
-	# Replace [Illustration: caption] markup with equivalent .il/.ca statements
+def convertIllustrationChunk( inBuf, isLast=True ):
+	# Replace [Illustration: caption] markup in inBuf with .il/.ca statements.
+	# Which image a tag gets depends on the tags before it, so the .il line is
+	# left as a placeholder and the tag is returned for processIllustrations to
+	# resolve in source order. Returns None when a tag runs past the end of a
+	# chunk that is not the last one.
 	outBuf = []
+	tags = []
 	lineNum = 0
 	currentScanPage = 0
 	illustrationTagCount = 0
 	asteriskIllustrationTagCount = 0
-	#TODO use format() instead of +
-
-	logging.info("-- Processing illustrations")
 
-	illustrations = buildImageDictionary()
-
-	logging.info("--- Converting [Illustration] tags")
 	while lineNum < len(inBuf):
 		# Keep track of active scanpage, page numbers must be
 		pn = parseScanPage(inBuf[lineNum])
 		if pn:
 			currentScanPage = os.path.splitext(pn)[0]
-			logging.debug("--- Processing page {}".format(pn))
 
 		# Copy until next illustration block
 		if re.match(r"^\[Illustration", inBuf[lineNum]) or re.match(r"^\*\[Illustration", inBuf[lineNum]):
@@ -417,7 +715,8 @@ def processIllustrations( inBuf ):
 			# Copy illustration block
 			bracketLevel = 0
 			done = False
-			while lineNum < len(inBuf)-1 and not done:
+			lastLine = len(inBuf)-1 if isLast else len(inBuf)
+			while lineNum < lastLine and not done:
 				# Detect when [ ] level so that nested [] are handled properly
 				m = re.findall("\[", inBuf[lineNum])
 				for b in m:
@@ -432,30 +731,12 @@ def processIllustrations( inBuf ):
 				inBlock.append(inBuf[lineNum])
 				lineNum += 1
 
-			# Handle multiple illustrations per page, must be named (i_001a, i_001b, ...) or (i_001, i_001a, i_001b, ...)
-			ilID = None
-			testID = idFromPageNumber(currentScanPage)
-			if testID in illustrations and illustrations[testID]['usageCount'] == 0:
-				ilID = testID
-			else: # try i_001a, i_001b, ..., i_001z
-				alphabet = map(chr, range(97,123))
-				for letter in alphabet:
-					if testID+letter in illustrations and illustrations[testID+letter]['usageCount'] == 0:
-						ilID = testID+letter
-						break;
-
-			if ilID == None and testID in illustrations:
-				ilID = testID
-			elif ilID == None:
-				logging.error("No image file for illustration located on scan page {}".format(currentScanPage));
+			if not done and not isLast:
+				return None
 
-			if ilID:
-				# Convert to ppgen illustration block
-				# .il id=i001 fn=i_001.jpg w=600 alt=''
-				outBlock.append(".il id={} fn={} w={}px alt=''".format(ilID,illustrations[ilID]['fileName'],str(illustrations[ilID]['dimensions'][0])))
-				illustrations[ilID]['usageCount'] += 1
-			else:
-				outBlock.append(".il id={} fn={} alt=''".format(testID,testID))
+			# .il statement is filled in once the image is known
+			tags.append({'outLine':len(outBuf), 'lineNum':lineNum, 'scanPage':currentScanPage, 'inBlock':inBlock})
+			outBlock.append(None)
 
 			# Extract caption from illustration block
 			captionBlock = []
@@ -483,21 +764,83 @@ def processIllustrations( inBuf ):
 			for line in outBlock:
 				outBuf.append(line)
 
-			logging.debug("Line " + str(lineNum) + ": ScanPage " + str(currentScanPage) + ": convert " + str(inBlock))
-
 		else:
 			outBuf.append(inBuf[lineNum])
 			lineNum += 1
 
-	logging.info("--- Processed {} [Illustrations] tags".format(illustrationTagCount))
+	return outBuf, tags, illustrationTagCount, asteriskIllustrationTagCount
+
+
+def processIllustrations( inBuf, project=None ):
+	project = project if project else Project()
+	# Replace [Illustration: caption] markup with equivalent .il/.ca statements
+	outBuf = []
+	illustrationTagCount = 0
+	asteriskIllustrationTagCount = 0
+	#TODO use format() instead of +
+
+	project.log.info("-- Processing illustrations")
+
+	illustrations = buildImageDictionary(project)
+	unusedImages = buildImageIndex(illustrations)
+	pageImages = buildImageIndex(illustrations)
+
+	project.log.info("--- Converting [Illustration] tags")
+	chunks = splitForJobs(inBuf, project)
+	results = mapChunks(convertIllustrationChunk, chunks, project)
+	if None in results:
+		project.log.debug("--- [Illustration] tag spans a chunk boundary, converting sequentially")
+		chunks = [(0, inBuf)]
+		results = [convertIllustrationChunk(inBuf)]
+
+	# Assign images in source order so the result does not depend on how the
+	# source was split
+	for (offset, chunk), (chunkBuf, tags, tagCount, asteriskTagCount) in zip(chunks, results):
+		illustrationTagCount += tagCount
+		asteriskIllustrationTagCount += asteriskTagCount
+
+		for tag in tags:
+			currentScanPage = tag['scanPage']
+
+			# Handle multiple illustrations per page, must be named (i_001a, i_001b, ...) or (i_001, i_001a, i_001b, ...)
+			ilID = None
+			testID = idFromPageNumber(currentScanPage)
+			pageKey = scanPageKey(currentScanPage)
+			if unusedImages.get(pageKey):
+				ilID = unusedImages[pageKey].popleft()
+
+			# All images on the page are used, reuse the first one
+			if ilID == None and pageImages.get(pageKey):
+				ilID = pageImages[pageKey][0]
+			elif ilID == None:
+				project.log.error("No image file for illustration located on scan page {}".format(currentScanPage));
+
+			if ilID:
+				# Convert to ppgen illustration block
+				# .il id=i001 fn=i_001.jpg w=600 alt=''
+				chunkBuf[tag['outLine']] = ".il id={} fn={} w={}px alt=''".format(illustrations[ilID]['anchorID'],illustrations[ilID]['fileName'],str(illustrations[ilID]['dimensions'][0]))
+				illustrations[ilID]['usageCount'] += 1
+			else:
+				chunkBuf[tag['outLine']] = ".il id={} fn={} alt=''".format(testID,testID)
+
+			project.log.debug("Line " + str(offset + tag['lineNum']) + ": ScanPage " + str(currentScanPage) + ": convert " + str(tag['inBlock']))
+
+		outBuf.extend(chunkBuf)
+
+	for k, i in sorted(illustrations.items()):
+		if i['usageCount'] == 0 and i['fileName'] != "cover.jpg":
+			project.log.warning("Image '{}' was not assigned to any [Illustration] tag".format(i['fileName']))
+
+	project.log.info("--- Processed {} [Illustrations] tags".format(illustrationTagCount))
 	if asteriskIllustrationTagCount > 0:
-		logging.warning("Found {} *[Illustrations] tags; ppgen .il/.ca statements have been generated, but relocation to paragraph break must be performed manually.".format(asteriskIllustrationTagCount))
+		project.log.warning("Found {} *[Illustrations] tags; ppgen .il/.ca statements have been generated, but relocation to paragraph break must be performed manually.".format(asteriskIllustrationTagCount))
 
 	return outBuf;
 
 
 def generateIlStatement( args ):
 	ilStatement = ".il"
+	args = dict(args) # parameters are consumed below, leave callers dict alone
 
 	# Add quotes where needed (parameters with spaces)
 	for k, v in args.items():
@@ -539,18 +882,19 @@ def generateIlStatement( args ):
 	return ilStatement
 
 
-def updateWidths( inBuf ):
-	outBuf = inBuf
+def updateWidths( inBuf, project=None ):
+	project = project if project else Project()
+	outBuf = list(inBuf)
 
-	logging.info("-- Updating widths")
+	project.log.info("-- Updating widths")
 
-	illustrations = parseIllustrationBlocks(inBuf)
-	images = buildImageDictionary()
+	illustrations = parseIllustrationBlocks(inBuf, project)
+	images = buildImageDictionary(project)
 
 	# update width parameter in each .il statement
-	logging.info("--- Modifying .il statements to match actual width dimension of image file")
+	project.log.info("--- Modifying .il statements to match actual width dimension of image file")
 	for k, il in illustrations.items():
-		logging.debug("Original .il: {}".format(il['ilStatement']))
+		project.log.debug("Original .il: {}".format(il['ilStatement']))
 
 		ilParams = il['ilParams']
 		curWidth = ilParams['w']
@@ -566,7 +910,7 @@ def updateWidths( inBuf ):
 		newIlStatement = generateIlStatement(ilParams)
 		outBuf[il['startLine']] = newIlStatement
 
-		logging.debug("Modified .il: {}".format(newIlStatement))
+		project.log.debug("Modified .il: {}".format(newIlStatement))
 
 	return outBuf
 
@@ -580,7 +924,8 @@ def loadFile(fn):
 
 	if encoding == "":
 		try:
-			wbuf = open(fn, "r", encoding='ascii').read()
+			with open(fn, "r", encoding='ascii') as f:
+				wbuf = f.read()
 			encoding = "ASCII" # we consider ASCII as a subset of Latin-1 for DP purposes
 			inBuf = wbuf.split("\n")
 		except Exception as e:
@@ -588,7 +933,8 @@ def loadFile(fn):
 
 	if encoding == "":
 		try:
-			wbuf = open(fn, "rU", encoding='UTF-8').read()
+			with open(fn, "r", encoding='UTF-8') as f:
+				wbuf = f.read()
 			encoding = "utf_8"
 			inBuf = wbuf.split("\n")
 			# remove BOM on first line if present
@@ -600,7 +946,8 @@ def loadFile(fn):
 
 	if encoding == "":
 		try:
-			wbuf = open(fn, "r", encoding='latin_1').read()
+			with open(fn, "r", encoding='latin_1') as f:
+				wbuf = f.read()
 			encoding = "latin_1"
 			inBuf = wbuf.split("\n")
 		except Exception as e:
@@ -624,37 +971,39 @@ def createOutputFileName( infile ):
 	return outfile
 
 
-def getTargetWidth( image ):
-	json_data=open('images.json')
+def getTargetWidth( image, project=None ):
+	project = project if project else Project()
 
-	data = json.load(json_data)
+	with open(project.jsonFile) as json_data:
+		data = json.load(json_data)
 	width = data[image]['targetWidth']
-	json_data.close()
 
 	return width
 
-def loadJSON( fn ):
+def loadJSON( fn, project=None ):
+	project = project if project else Project()
 	data = {}
 	try:
 		with open(fn) as f:
 			data = json.load(f)
 	except:
-		logging.info("--- Error loading JSON file '{}', using empty dictionary".format(fn))
+		project.log.info("--- Error loading JSON file '{}', using empty dictionary".format(fn))
 		pass
 	else:
-		logging.info("--- Loaded JSON from file '{}'".format(fn))
+		project.log.info("--- Loaded JSON from file '{}'".format(fn))
 
 
 	return data
 
 
-def calcImageWidths( inBuf, maxwidth ):
-	logging.info("-- Calculating widths")
+def calcImageWidths( inBuf, maxwidth, project=None ):
+	project = project if project else Project()
+	project.log.info("-- Calculating widths")
 
-	illustrations = parseIllustrationBlocks(inBuf)
-	images = buildImageDictionary()
+	illustrations = parseIllustrationBlocks(inBuf, project)
+	images = buildImageDictionary(project)
 
-	jsonData = loadJSON("images.json")
+	jsonData = loadJSON(project.jsonFile, project)
 
 	for k, il in illustrations.items():
 		ilParams = il['ilParams']
@@ -666,14 +1015,14 @@ def calcImageWidths( inBuf, maxwidth ):
 			scale = int(re.sub("%", "", ilParams['ew'])) / 100.0
 		else:
 			scale = 0
-			logging.error("w or ew parameter must be expressed in % for width to be calculated")
+			project.log.error("w or ew parameter must be expressed in % for width to be calculated")
 
 		calculatedWidth = "{}".format(int(scale * int(maxwidth)))
 
 		# Add to data
-		key = "images/"+ilParams['fn']
-		logging.info("Calculated width for {}: {}".format(key, calculatedWidth))
-		jsonData[key] = ({'targetWidth':calculatedWidth})
+		key = project.jsonKey(ilParams['fn'])
+		project.log.info("Calculated width for {}: {}".format(key, calculatedWidth))
+		jsonData.setdefault(key, {})['targetWidth'] = calculatedWidth
 #		images[scanPageNum] = ({'anchorID':anchorID, 'fileName':f, 'scanPageNum':scanPageNum, 'dimensions':img.size, 'caption':"", 'usageCount':0 })
 
 	# Fallback to percentage scaling for images that are not defined through .il
@@ -682,31 +1031,282 @@ def calcImageWidths( inBuf, maxwidth ):
 			calculatedWidth = "40%"
 
 			# Add to data
-			key = "images/"+i['fileName']
-			logging.info("Calculated width for {}: {}".format(key, calculatedWidth))
-			jsonData[key] = ({'targetWidth':calculatedWidth})
+			key = project.jsonKey(i['fileName'])
+			project.log.info("Calculated width for {}: {}".format(key, calculatedWidth))
+			jsonData.setdefault(key, {})['targetWidth'] = calculatedWidth
 
 
-	logging.info("--- Updating images.json with calculated widths")
+	project.log.info("--- Updating images.json with calculated widths")
 	# Write out JSON
-	f = open("images.json",'w')
-	f.write(json.dumps(jsonData))
-	f.close()
+	with open(project.jsonFile,'w') as f:
+		f.write(json.dumps(jsonData))
 
 	# Change last modifed time of illustration masters to force resize on next invocation of make
-	masterImageFiles = glob.glob(os.path.abspath('originals/illustrations')+'/*')
-	commandLine=['touch'] + masterImageFiles # TODO: this wont work on windows..
-	proc=subprocess.Popen(commandLine)
-	proc.wait()
-	if proc.returncode != 0:
-		fatal("Error occured processing {}".format(commandLine))
+	masterImageFiles = glob.glob(os.path.join(project.originalsDir, "*"))
+	for fn in masterImageFiles:
+		try:
+			os.utime(fn)
+		except OSError as e:
+			fatal("Error occured updating modification time of '{}': {}".format(fn,e))
+
+	project.log.info("*************************************************")
+	project.log.info("***                                          ****")
+	project.log.info("***  RUN 'make' TO RESCALE FILES IN images/  ****")
+	project.log.info("***  THEN 'ppimg -w' TO UPDATE PPGEN SRC     ****")
+	project.log.info("***                                          ****")
+	project.log.info("*************************************************")
+
+
+# Modes that convert to RGB without losing detail
+OPTIMIZE_MODES = ['1', 'L', 'LA', 'P', 'RGB', 'RGBA']
+
+
+def classifyImage( img ):
+	# Classify image content as bilevel, grayscale, palette (<= 256 colors) or
+	# photo, along with its RGB pixels as a (height, width, 3) array
+	pixels = numpy.asarray(img.convert("RGB"), dtype=numpy.uint32)
+	r, g, b = pixels[...,0], pixels[...,1], pixels[...,2]
+
+	if numpy.array_equal(r, g) and numpy.array_equal(g, b):
+		if numpy.isin(r, (0, 255)).all():
+			return 'bilevel', pixels
+		return 'grayscale', pixels
+
+	if len(numpy.unique((r << 16) | (g << 8) | b)) <= 256:
+		return 'palette', pixels
+
+	return 'photo', pixels
+
+
+def reduceImage( img, classification, pixels ):
+	# Convert to the smallest mode that holds the same pixels
+	r, g, b = pixels[...,0], pixels[...,1], pixels[...,2]
+
+	if classification == 'bilevel':
+		return Image.fromarray(r == 255)
+	elif classification == 'grayscale':
+		return Image.fromarray(r.astype(numpy.uint8))
+	elif classification == 'palette':
+		colors, indices = numpy.unique((r << 16) | (g << 8) | b, return_inverse=True)
+		reduced = Image.frombytes("P", (r.shape[1], r.shape[0]), indices.astype(numpy.uint8).tobytes())
+		palette = numpy.stack(((colors >> 16) & 255, (colors >> 8) & 255, colors & 255), axis=1)
+		reduced.putpalette(palette.astype(numpy.uint8).tobytes())
+		return reduced
+
+	return img
+
+
+def saveOptions( img ):
+	# Metadata to carry over when an image is re-encoded
+	options = {}
+	for k in ['dpi', 'icc_profile', 'exif']:
+		if k in img.info:
+			options[k] = img.info[k]
+
+	if img.format == "PNG" and getattr(img, 'text', None):
+		pnginfo = PngImagePlugin.PngInfo()
+		for k, v in img.text.items():
+			pnginfo.add_text(k, v)
+		options['pnginfo'] = pnginfo
+
+	return options
+
+
+def optimizeImage( fn, dryRun=False ):
+	# Re-encode fn losslessly, keeping the result only if it is smaller.
+	# PNGs are reduced to bilevel/grayscale/palette mode where the content
+	# allows. Files that are left alone get the reason in 'skipped'.
+	oldSize = os.path.getsize(fn)
+	result = {'fileName':os.path.basename(fn), 'classification':None, 'skipped':None, 'oldSize':oldSize, 'newSize':oldSize}
+
+	try:
+		with Image.open(fn) as img:
+			# JPEGs cannot be rewritten without decoding and re-encoding them
+			if img.format != "PNG":
+				result['skipped'] = "{} is not re-encoded, it would lose quality".format(img.format)
+				return result
+
+			# Wide modes (I;16, I, F, ...) do not survive conversion to RGB
+			if not img.mode in OPTIMIZE_MODES:
+				result['skipped'] = "mode {} is not supported".format(img.mode)
+				return result
+
+			img.load()
+			result['classification'], pixels = classifyImage(img)
+
+			hasAlpha = 'A' in img.mode or 'transparency' in img.info
+			if hasAlpha and not (numpy.asarray(img.convert("RGBA"))[...,3] == 255).all():
+				reduced = img # mode reduction would lose transparency
+			else:
+				reduced = reduceImage(img, result['classification'], pixels)
+
+				# Compare in the original mode, palette images by their colors
+				original = img.convert("RGBA") if img.mode == "P" else img
+				if not numpy.array_equal(numpy.asarray(reduced.convert(original.mode)), numpy.asarray(original)):
+					reduced = img
+
+			buf = io.BytesIO()
+			reduced.save(buf, "PNG", optimize=True, **saveOptions(img))
+	except IOError as e:
+		result['skipped'] = "error loading ({})".format(e)
+		return result
+
+	if buf.tell() < oldSize:
+		result['newSize'] = buf.tell()
+		if not dryRun:
+			tempFileName = fn + ".ppimg"
+			with open(tempFileName, 'wb') as f:
+				f.write(buf.getvalue())
+			os.replace(tempFileName, fn)
+
+	return result
 
-	logging.info("*************************************************")
-	logging.info("***                                          ****")
-	logging.info("***  RUN 'make' TO RESCALE FILES IN images/  ****")
-	logging.info("***  THEN 'ppimg -w' TO UPDATE PPGEN SRC     ****")
-	logging.info("***                                          ****")
-	logging.info("*************************************************")
+
+def logSkippedImage( result, project ):
+	if result['skipped'].startswith("error loading"):
+		project.log.warning("{}: {} ... skipping".format(result['fileName'],result['skipped']))
+	else:
+		project.log.info("{}: left alone, {}".format(result['fileName'],result['skipped']))
+
+
+def optimizeImages( project=None, dryRun=False ):
+	project = project if project else Project()
+	project.log.info("-- Optimizing images")
+
+	if numpy == None:
+		fatal("numpy is required to optimize images (pip install numpy)")
+
+	files = sorted(f for f in glob.glob(os.path.join(project.imageDir, "*")) if re.search(r"\.(png|jpg|jpeg)$", f, re.IGNORECASE))
+
+	if project.jobs > 1 and len(files) > 1:
+		with project.executor() as executor:
+			results = list(executor.map(optimizeImage, files, [dryRun] * len(files)))
+	else:
+		results = [optimizeImage(f, dryRun) for f in files]
+
+	oldTotal = 0
+	newTotal = 0
+	for r in results:
+		oldTotal += r['oldSize']
+		newTotal += r['newSize']
+		if r['skipped']:
+			logSkippedImage(r, project)
+			continue
+		saved = r['oldSize'] - r['newSize']
+		project.log.info("{} ({}): {}KB -> {}KB, saved {}KB".format(r['fileName'],r['classification'],int(r['oldSize']/1000),int(r['newSize']/1000),int(saved/1000)))
+
+	project.log.info("--- Saved {}KB of {}KB across {} images{}".format(int((oldTotal-newTotal)/1000),int(oldTotal/1000),len(results)," (dry run)" if dryRun else ""))
+
+	return results
+
+
+def findContentBox( img, tolerance=16, scale=4 ):
+	# Bounding box (left, upper, right, lower) of everything that differs from
+	# the border color by more than tolerance. Works on a copy downsampled by
+	# scale and widens the box by one block so faint edges are not cut.
+	small = img.convert("RGB").reduce(scale) if min(img.size) >= scale * 2 else img.convert("RGB")
+	scale = img.size[0] / small.size[0], img.size[1] / small.size[1]
+	pixels = numpy.asarray(small, dtype=numpy.int16)
+
+	border = numpy.concatenate((pixels[0], pixels[-1], pixels[:,0], pixels[:,-1]))
+	background = numpy.median(border, axis=0)
+	content = (numpy.abs(pixels - background) > tolerance).any(axis=2)
+
+	rows = numpy.flatnonzero(content.any(axis=1))
+	cols = numpy.flatnonzero(content.any(axis=0))
+	if len(rows) == 0 or len(cols) == 0:
+		return (0, 0) + img.size
+
+	left = max(0, int((cols[0] - 1) * scale[0]))
+	upper = max(0, int((rows[0] - 1) * scale[1]))
+	right = min(img.size[0], int(round((cols[-1] + 2) * scale[0])))
+	lower = min(img.size[1], int(round((rows[-1] + 2) * scale[1])))
+
+	return (left, upper, right, lower)
+
+
+def trimImage( fn, tolerance=16, dryRun=False ):
+	# Crop plain margins from fn. Returns dimensions and file sizes before and
+	# after, the file is only rewritten when not a dry run. Files that are
+	# left alone get the reason in 'skipped'.
+	oldSize = os.path.getsize(fn)
+	result = {'fileName':os.path.basename(fn), 'skipped':None, 'oldDimensions':None, 'newDimensions':None, 'oldSize':oldSize, 'newSize':oldSize}
+
+	try:
+		with Image.open(fn) as img:
+			result['oldDimensions'] = result['newDimensions'] = img.size
+
+			# Cropping a JPEG means decoding and re-encoding it
+			if img.format != "PNG":
+				result['skipped'] = "{} is not re-encoded, it would lose quality".format(img.format)
+				return result
+
+			# Wide modes (I;16, I, F, ...) do not survive conversion to RGB
+			if not img.mode in OPTIMIZE_MODES:
+				result['skipped'] = "mode {} is not supported".format(img.mode)
+				return result
+
+			# Transparent margins are left alone
+			if 'A' in img.mode or 'transparency' in img.info:
+				return result
+
+			img.load()
+			box = findContentBox(img, tolerance)
+			if box == (0, 0) + img.size:
+				return result
+
+			cropped = img.crop(box)
+			buf = io.BytesIO()
+			cropped.save(buf, "PNG", optimize=True, **saveOptions(img))
+	except IOError as e:
+		result['skipped'] = "error loading ({})".format(e)
+		return result
+
+	result['newDimensions'] = cropped.size
+	result['newSize'] = buf.tell()
+	if not dryRun:
+		tempFileName = fn + ".ppimg"
+		with open(tempFileName, 'wb') as f:
+			f.write(buf.getvalue())
+		os.replace(tempFileName, fn)
+
+	return result
+
+
+def trimImages( project=None, tolerance=16, dryRun=False ):
+	project = project if project else Project()
+	project.log.info("-- Trimming image borders")
+
+	if numpy == None:
+		fatal("numpy is required to trim images (pip install numpy)")
+
+	if glob.glob(os.path.join(project.originalsDir, "*")):
+		project.log.warning("{} is rebuilt from {} by 'make', which will restore the trimmed borders and undo the updated .il widths".format(project.imageDir,project.originalsDir))
+
+	files = sorted(f for f in glob.glob(os.path.join(project.imageDir, "*")) if re.search(r"\.(png|jpg|jpeg)$", f, re.IGNORECASE))
+
+	if project.jobs > 1 and len(files) > 1:
+		with project.executor() as executor:
+			results = list(executor.map(trimImage, files, [tolerance] * len(files), [dryRun] * len(files)))
+	else:
+		results = [trimImage(f, tolerance, dryRun) for f in files]
+
+	pixelsSaved = 0
+	bytesSaved = 0
+	for r in results:
+		if r['skipped']:
+			logSkippedImage(r, project)
+			continue
+		if r['oldDimensions'] == r['newDimensions']:
+			continue
+		pixels = r['oldDimensions'][0] * r['oldDimensions'][1] - r['newDimensions'][0] * r['newDimensions'][1]
+		pixelsSaved += pixels
+		bytesSaved += r['oldSize'] - r['newSize']
+		project.log.info("{}: {}x{} -> {}x{}, saved {} pixels, {}KB".format(r['fileName'],r['oldDimensions'][0],r['oldDimensions'][1],r['newDimensions'][0],r['newDimensions'][1],pixels,int((r['oldSize']-r['newSize'])/1000)))
+
+	project.log.info("--- Saved {} pixels, {}KB across {} images{}".format(pixelsSaved,int(bytesSaved/1000),len(results)," (dry run)" if dryRun else ""))
+
+	return results
 
 
 def main():
@@ -722,11 +1322,29 @@ def main():
 	logging.basicConfig(format='%(levelname)s: %(message)s', level=logLevel)
 	logging.debug(args)
 
+	try:
+		run(args, Project(jobs=parseInt(args['--jobs'], "--jobs", 1)))
+	except PPImgError as e:
+		logging.critical(e)
+		sys.exit(1)
+
+	return
+
+
+def run( args, project ):
+	if args['--trim']:
+		trimImages(project, parseInt(args['--trimtolerance'], "--trimtolerance"), args['--dryrun'])
+		if not args['<infile>'] and not args['--dryrun']:
+			project.log.warning("No source file given, run 'ppimg -w <infile>' to update .il widths to the trimmed images")
+
+	if args['--optimize']:
+		optimizeImages(project, args['--dryrun'])
+
 	if args['--gettargetwidth']:
-		width = getTargetWidth(args['--gettargetwidth'])
+		width = getTargetWidth(args['--gettargetwidth'], project)
 		print(width)
 
-	else:
+	elif args['<infile>']:
 		# Process required command line arguments
 		outfile = createOutputFileName(args['<infile>'])
 		if args['<outfile>']:
@@ -740,7 +1358,7 @@ def main():
 		# Process optional command line arguments
 		doBoilerplate = args['--boilerplate']
 		doIllustrations = args['--illustrations']
-		doUpdateWidths = args['--updatewidths']
+		doUpdateWidths = args['--updatewidths'] and not args['--trim']
 		doCalcImageWidths = args['--calcimagewidths']
 		doCheckIssues = args['--check']
 
@@ -750,22 +1368,27 @@ def main():
 	#		doIllustrations = True;
 
 		# Process source document
-		logging.info("Processing '{}' to '{}'".format(infile,outfile))
+		project.log.info("Processing '{}' to '{}'".format(infile,outfile))
 		outBuf = []
+		if args['--trim']:
+			# Refresh widths to the trimmed images before any other conversion
+			outBuf = updateWidths(inBuf, project)
+			inBuf = outBuf
+
 		if doIllustrations:
-			outBuf = processIllustrations(inBuf)
+			outBuf = processIllustrations(inBuf, project)
 			inBuf = outBuf
 		elif doBoilerplate:
-			outBuf = generateHTMLBoilerplate(inBuf)
+			outBuf = generateHTMLBoilerplate(inBuf, project, args['--native'])
 			inBuf = outBuf
 		elif doUpdateWidths:
-			outBuf = updateWidths(inBuf)
+			outBuf = updateWidths(inBuf, project)
 			inBuf = outBuf
 		elif doCalcImageWidths:
-			calcImageWidths(inBuf, args['--maxwidth'])
+			calcImageWidths(inBuf, args['--maxwidth'], project)
 
 		if doCheckIssues:
-			checkForIssues(inBuf)
+			checkForIssues(inBuf, project)
 
 		if outBuf and not args['--dryrun']:
 			with open(outfile, mode='wt', encoding='utf-8') as f:
@@ -0,0 +1,26 @@
+#!/usr/bin/env python
+
+# Regenerate the <name>.expected files in this directory by running ppgen
+# (which must be installed) against each <name>.txt. The expected files are
+# what tests/test_boilerplate.py compares the native renderer against.
+
+import glob
+import logging
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+import ppimg
+
+
+def main():
+	logging.basicConfig(format='%(levelname)s: %(message)s', level=logging.INFO)
+
+	for fn in sorted(glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)), "*.txt"))):
+		outBuf = ppimg.generateHTMLBoilerplate(ppimg.loadFile(fn), ppimg.Project(os.path.dirname(fn)))
+		with open(os.path.splitext(fn)[0] + ".expected", mode='wt', encoding='utf-8') as f:
+			f.write('\n'.join(outBuf))
+
+
+if __name__ == "__main__":
+	main()
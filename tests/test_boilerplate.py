@@ -0,0 +1,82 @@
+import glob
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import ppimg
+
+GOLDEN = os.path.join(os.path.dirname(os.path.abspath(__file__)), "golden")
+
+
+@pytest.mark.parametrize("fn", sorted(glob.glob(os.path.join(GOLDEN, "*.txt"))), ids=os.path.basename)
+def test_native_matches_ppgen( fn ):
+	expectedFile = os.path.splitext(fn)[0] + ".expected"
+	if not os.path.isfile(expectedFile):
+		pytest.skip("no ppgen output captured, run tests/golden/capture.py")
+
+	with open(expectedFile, encoding='utf-8') as f:
+		expected = f.read()
+
+	outBuf = ppimg.generateHTMLBoilerplate(ppimg.loadFile(fn), ppimg.Project(GOLDEN), native=True)
+	assert '\n'.join(outBuf) == expected
+
+
+def test_figure_css_order_independent_of_first_use():
+	inBuf = [".il id=i_001 fn=i_001.jpg w=100px align=r", "", ".il id=i_002 fn=i_002.jpg w=100px", ""]
+	illustrations = ppimg.parseIllustrationBlocks(inBuf)
+	cssLines = ppimg.renderIllustrations(illustrations, ppimg.Project())
+
+	assert cssLines.index(ppimg.FIGURE_CSS['c'][0]) < cssLines.index(ppimg.FIGURE_CSS['r'][0])
+
+
+def test_illustration_without_id_needs_ppgen():
+	illustrations = ppimg.parseIllustrationBlocks([".il fn=i_001.jpg w=100px", ""])
+
+	assert ppimg.renderIllustrations(illustrations, ppimg.Project()) == None
+
+
+def render( name, key, number=1 ):
+	illustrations = ppimg.parseIllustrationBlocks(ppimg.loadFile(os.path.join(GOLDEN, name)))
+	return ppimg.renderIllustrationHTML(illustrations[key], number)
+
+
+def test_link_wraps_image():
+	html, css = render("widths.txt", "i_013", 4)
+
+	assert '<a href="images/i_013_large.jpg"><img alt="Linked" class="ig004" src="images/i_013.jpg"/></a>' in html.split("\n")
+
+
+def test_ew_sets_handheld_margin():
+	html, css = render("widths.txt", "i_012", 3)
+
+	assert css == [".id003 { width:450px; }",
+	               "@media handheld { .id003 { margin-left:20%; width:60%; } }",
+	               ".ig003 { width:100%; }",
+	               ".ic003 { width:100%; }"]
+
+
+def test_right_aligned_ew_has_no_margin():
+	html, css = render("align.txt", "i_003", 3)
+
+	assert html.startswith('<div class="figright id003" id="i_003">')
+	assert "@media handheld { .id003 { margin-left:0%; width:35%; } }" in css
+
+
+def test_multi_paragraph_caption():
+	html, css = render("captions.txt", "i_022", 3)
+
+	assert html.split("\n") == ['<div class="figcenter id003" id="i_022">',
+	                            '<img alt="" class="ig003" src="images/i_022.jpg"/>',
+	                            '<div class="ic003">',
+	                            '<p>First paragraph<br/>of the caption.</p>',
+	                            '<p>Second paragraph.</p>',
+	                            '</div>',
+	                            '</div>']
+
+
+def test_caption_ampersand_escaped():
+	html, css = render("captions.txt", "i_020")
+
+	assert "<p>Single line caption with <i>italics</i> &amp; an ampersand.</p>" in html.split("\n")
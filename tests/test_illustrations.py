@@ -0,0 +1,74 @@
+import json
+import logging
+import os
+import sys
+
+import pytest
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import ppimg
+
+
+def makeProject( path, files, settings=None ):
+	os.mkdir(path / "images")
+	for fn in files:
+		Image.new("RGB", (50 + len(fn), 20)).save(path / "images" / fn)
+	if settings != None:
+		with open(path / "images.json", 'w') as f:
+			json.dump(settings, f)
+	return ppimg.Project(path)
+
+
+def ilIDs( outBuf ):
+	return [ppimg.parseArgs(line)['id'] for line in outBuf if line.startswith(".il ")]
+
+
+def test_queue_order_with_json_mapped_image( tmp_path ):
+	project = makeProject(tmp_path, ["i_012.png", "i_012a.png", "plate3.jpg"],
+		{"images/plate3.jpg": {"id": "i_012b", "scanPage": 12}})
+	inBuf = ["-----File: 012.png---", "[Illustration: one]", "[Illustration: two]", "[Illustration: three]", ""]
+
+	outBuf = ppimg.processIllustrations(inBuf, project)
+
+	assert ilIDs(outBuf) == ["i_012", "i_012a", "i_012b"]
+	assert "fn=plate3.jpg" in [line for line in outBuf if line.startswith(".il ")][2]
+
+
+@pytest.mark.parametrize("scanPage", [12, "012", "0012"])
+def test_scan_page_normalized( tmp_path, scanPage ):
+	project = makeProject(tmp_path, ["plate3.jpg"], {"images/plate3.jpg": {"id": "i_012", "scanPage": scanPage}})
+
+	outBuf = ppimg.processIllustrations(["-----File: 012.png---", "[Illustration: plate]", ""], project)
+
+	assert ilIDs(outBuf) == ["i_012"]
+
+
+def test_used_image_reused_for_differently_padded_page( tmp_path, caplog ):
+	project = makeProject(tmp_path, ["i_012.png"])
+	inBuf = ["-----File: 0012.png---", "[Illustration: one]", "[Illustration: two]", ""]
+
+	with caplog.at_level(logging.ERROR, logger="ppimg"):
+		outBuf = ppimg.processIllustrations(inBuf, project)
+
+	assert ilIDs(outBuf) == ["i_012", "i_012"]
+	assert not "No image file" in caplog.text
+
+
+def test_unassigned_image_reported( tmp_path, caplog ):
+	project = makeProject(tmp_path, ["i_001.png", "i_002.png", "cover.jpg"])
+
+	with caplog.at_level(logging.WARNING, logger="ppimg"):
+		ppimg.processIllustrations(["-----File: 001.png---", "[Illustration: one]", ""], project)
+
+	assert "Image 'i_002.png' was not assigned" in caplog.text
+	assert not "cover.jpg" in caplog.text
+
+
+def test_calc_image_widths_keeps_json_settings( tmp_path ):
+	project = makeProject(tmp_path, ["plate3.jpg"], {"images/plate3.jpg": {"id": "i_012b", "scanPage": 12}})
+
+	ppimg.calcImageWidths([".il id=i_012b fn=plate3.jpg w=50%", ""], 600, project)
+
+	with open(tmp_path / "images.json") as f:
+		assert json.load(f)["images/plate3.jpg"] == {"id": "i_012b", "scanPage": 12, "targetWidth": "300"}
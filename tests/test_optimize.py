@@ -0,0 +1,65 @@
+import os
+import sys
+
+import numpy
+import pytest
+from PIL import Image, PngImagePlugin
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import ppimg
+
+
+def pngInfo():
+	info = PngImagePlugin.PngInfo()
+	info.add_text("Comment", "scanned plate")
+	return info
+
+
+def test_grayscale_png_reduced_losslessly( tmp_path ):
+	fn = str(tmp_path / "i_001.png")
+	gray = (numpy.arange(200 * 300).reshape(200, 300) % 7 * 30).astype(numpy.uint8)
+	Image.fromarray(gray).convert("RGB").save(fn, dpi=(300, 300), pnginfo=pngInfo())
+
+	result = ppimg.optimizeImage(fn)
+
+	assert result['classification'] == 'grayscale'
+	assert result['newSize'] < result['oldSize']
+	with Image.open(fn) as img:
+		assert img.mode == "L"
+		assert numpy.array_equal(numpy.asarray(img), gray)
+		assert round(img.info['dpi'][0]) == 300
+		assert img.text["Comment"] == "scanned plate"
+
+
+def test_16bit_png_untouched( tmp_path ):
+	fn = str(tmp_path / "i_002.png")
+	Image.fromarray((numpy.arange(100 * 100).reshape(100, 100) * 6).astype(numpy.uint16)).save(fn)
+	before = open(fn, 'rb').read()
+
+	result = ppimg.optimizeImage(fn)
+
+	assert result['skipped'].startswith("mode")
+	assert open(fn, 'rb').read() == before
+
+
+def test_jpeg_untouched( tmp_path ):
+	fn = str(tmp_path / "i_003.jpg")
+	Image.new("RGB", (200, 100), "white").save(fn, quality=85)
+	before = open(fn, 'rb').read()
+
+	result = ppimg.optimizeImage(fn)
+
+	assert result['skipped'].startswith("JPEG")
+	assert open(fn, 'rb').read() == before
+
+
+def test_unreadable_file_skipped( tmp_path ):
+	os.mkdir(tmp_path / "images")
+	with open(tmp_path / "images" / "i_001.png", 'w') as f:
+		f.write("not an image")
+	Image.new("RGB", (20, 20), "white").save(tmp_path / "images" / "i_002.png")
+
+	results = ppimg.optimizeImages(ppimg.Project(tmp_path))
+
+	assert results[0]['skipped'].startswith("error loading")
+	assert results[1]['classification'] == 'bilevel'
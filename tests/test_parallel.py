@@ -0,0 +1,58 @@
+import os
+import sys
+
+import pytest
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import ppimg
+
+
+@pytest.fixture
+def project( tmp_path ):
+	os.mkdir(tmp_path / "images")
+	for fn in ["i_007.png", "i_014.png", "i_014a.png", "i_021.png", "cover.jpg"]:
+		Image.new("RGB", (40 + len(fn), 20)).save(tmp_path / "images" / fn)
+	return tmp_path
+
+
+def buildSource( pages ):
+	lines = []
+	for p in range(1, pages+1):
+		lines.append("-----File: {:03d}.png---\\Proofer\\".format(p))
+		lines.append("Text on page {} [with brackets]".format(p))
+		if p % 7 == 0:
+			lines += ["[Illustration: Plate {}]".format(p), ""]
+		if p % 14 == 0:
+			lines += ["[Illustration: Second plate", "on [two] lines]", ""]
+		if p % 10 == 0:
+			lines += [".il id=i_{0:03d} fn=i_{0:03d}.png w=10px".format(p), ".ca", "Caption", ".ca-"]
+		if p % 25 == 0:
+			lines.append("[Illustration]") # last line before next page
+	lines.append("")
+	return lines
+
+
+@pytest.mark.parametrize("spanning", [False, True])
+def test_parallel_output_identical( project, monkeypatch, spanning ):
+	inBuf = buildSource(120)
+	if spanning:
+		# tag continuing onto the next scan page forces a sequential run
+		inBuf.insert(inBuf.index("-----File: 050.png---\\Proofer\\"), "*[Illustration: spans")
+		inBuf.insert(inBuf.index("-----File: 050.png---\\Proofer\\") + 1, "pages]")
+
+	expected = ppimg.processIllustrations(list(inBuf), ppimg.Project(project, jobs=1))
+	expectedIl = ppimg.parseIllustrationBlocks(expected, ppimg.Project(project, jobs=1))
+
+	# split at every page so each chunk boundary is exercised
+	monkeypatch.setattr(ppimg, "PARALLEL_MIN_LINES", 0)
+	monkeypatch.setattr(ppimg, "splitAtScanPages", lambda buf, n, split=ppimg.splitAtScanPages: split(buf, len(buf)))
+	outBuf = ppimg.processIllustrations(list(inBuf), ppimg.Project(project, jobs=2))
+
+	assert "\n".join(outBuf) == "\n".join(expected)
+	assert ppimg.parseIllustrationBlocks(outBuf, ppimg.Project(project, jobs=2)) == expectedIl
+
+
+def test_small_source_not_split( project ):
+	inBuf = buildSource(30)
+	assert ppimg.splitForJobs(inBuf, ppimg.Project(project, jobs=4)) == [(0, inBuf)]
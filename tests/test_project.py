@@ -0,0 +1,56 @@
+import json
+import os
+import sys
+
+import pytest
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import ppimg
+
+
+def test_generate_il_statement_leaves_args_alone():
+	args = {'id': "i_001", 'fn': "i_001.png", 'alt': "a plate", 'w': "100px"}
+	before = dict(args)
+
+	assert ppimg.generateIlStatement(args) == ".il id=i_001 fn=i_001.png alt='a plate' w=100px"
+	assert args == before
+
+
+def test_update_widths_leaves_input_alone( tmp_path ):
+	os.mkdir(tmp_path / "images")
+	Image.new("RGB", (123, 10)).save(tmp_path / "images" / "i_001.png")
+	inBuf = [".il id=i_001 fn=i_001.png w=50%", ""]
+	before = list(inBuf)
+
+	outBuf = ppimg.updateWidths(inBuf, ppimg.Project(tmp_path))
+
+	assert outBuf[0] == ".il id=i_001 fn=i_001.png w=123px ew=50%"
+	assert inBuf == before
+
+
+def test_fatal_raises():
+	with pytest.raises(ppimg.PPImgError):
+		ppimg.fatal("broken")
+	with pytest.raises(ppimg.PPImgError):
+		ppimg.loadFile("/nonexistent/book-src.txt")
+
+
+def test_main_reports_bad_jobs( monkeypatch ):
+	monkeypatch.setattr(sys, "argv", ["ppimg", "-j", "x", "book-src.txt"])
+	with pytest.raises(SystemExit) as e:
+		ppimg.main()
+	assert e.value.code == 1
+
+
+def test_project_outside_cwd( tmp_path, monkeypatch ):
+	os.mkdir(tmp_path / "images")
+	Image.new("RGB", (40, 10)).save(tmp_path / "images" / "plate.png")
+	with open(tmp_path / "images.json", 'w') as f:
+		json.dump({"images/plate.png": {"id": "i_007"}}, f)
+	monkeypatch.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+	images = ppimg.buildImageDictionary(ppimg.Project(tmp_path))
+
+	assert images['plate']['anchorID'] == "i_007"
+	assert images['plate']['dimensions'] == (40, 10)
@@ -0,0 +1,67 @@
+import os
+import sys
+
+import numpy
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import ppimg
+
+
+def test_content_box_keeps_content():
+	pixels = numpy.full((400, 300, 3), 240, numpy.uint8)
+	pixels[50:351, 40:261] = 0
+	box = ppimg.findContentBox(Image.fromarray(pixels))
+
+	assert box[0] <= 40 and box[1] <= 50 and box[2] >= 261 and box[3] >= 351
+	assert box != (0, 0, 300, 400)
+
+
+def test_trim_keeps_metadata( tmp_path ):
+	fn = str(tmp_path / "i_001.png")
+	pixels = numpy.full((400, 300, 3), 255, numpy.uint8)
+	pixels[100:200, 100:200] = 0
+	Image.fromarray(pixels).save(fn, dpi=(300, 300))
+
+	result = ppimg.trimImage(fn)
+
+	assert result['newDimensions'][0] < 300
+	with Image.open(fn) as img:
+		assert img.size == result['newDimensions']
+		assert round(img.info['dpi'][0]) == 300
+
+
+def test_16bit_png_untouched( tmp_path ):
+	fn = str(tmp_path / "i_002.png")
+	pixels = numpy.full((400, 300), 65535, numpy.uint16)
+	pixels[50:350, 40:260] = 30000 # mid grey plate, clipped to white in RGB
+	Image.fromarray(pixels).save(fn)
+	before = open(fn, 'rb').read()
+
+	result = ppimg.trimImage(fn)
+
+	assert result['skipped'].startswith("mode")
+	assert open(fn, 'rb').read() == before
+
+
+def test_jpeg_untouched( tmp_path ):
+	fn = str(tmp_path / "i_003.jpg")
+	pixels = numpy.full((400, 300, 3), 255, numpy.uint8)
+	pixels[100:200, 100:200] = 0
+	Image.fromarray(pixels).save(fn, quality=90)
+	before = open(fn, 'rb').read()
+
+	result = ppimg.trimImage(fn)
+
+	assert result['skipped'].startswith("JPEG")
+	assert open(fn, 'rb').read() == before
+
+
+def test_unreadable_file_skipped( tmp_path ):
+	os.mkdir(tmp_path / "images")
+	with open(tmp_path / "images" / "i_001.png", 'w') as f:
+		f.write("not an image")
+
+	results = ppimg.trimImages(ppimg.Project(tmp_path))
+
+	assert results[0]['skipped'].startswith("error loading")